@@ -108,3 +108,32 @@ class TestExtractFeatureUtils(unittest.TestCase):
                 np.array_equal(output["features"], features[output["inds"]])
             )
             self.assertTrue(np.array_equal(output["targets"], targets[output["inds"]]))
+
+    def test_merge_features_with_duplicates(self):
+        with in_temporary_directory() as temp_dir:
+            # Samples dumped by several ranks (for instance because of the
+            # padding of the distributed sampler) appear only once when merged,
+            # with the values of the last shard
+            indices = np.arange(0, 20)
+            features = np.random.random(size=(20, 16))
+            targets = np.random.randint(low=0, high=10, size=(20, 1))
+            shard0 = np.arange(0, 12)
+            save_file(features[shard0], "chunk0_train_heads_features.npy")
+            save_file(targets[shard0], "chunk0_train_heads_targets.npy")
+            save_file(indices[shard0], "chunk0_train_heads_inds.npy")
+
+            # The samples 8 to 11 are dumped again with different values
+            features[8:12] = np.random.random(size=(4, 16))
+            targets[8:12] = targets[8:12] + 10
+            shard1 = np.arange(8, 20)
+            save_file(features[shard1], "chunk1_train_heads_features.npy")
+            save_file(targets[shard1], "chunk1_train_heads_targets.npy")
+            save_file(indices[shard1], "chunk1_train_heads_inds.npy")
+
+            output = ExtractedFeaturesLoader.load_features(
+                input_dir=temp_dir, split="train", layer="heads"
+            )
+            self.assertEqual(output["features"].shape, (20, 16))
+            self.assertTrue(np.array_equal(output["inds"], indices))
+            self.assertTrue(np.array_equal(output["targets"], targets))
+            self.assertTrue(np.allclose(output["features"], features))
@@ -0,0 +1,166 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import math
+import os
+import unittest
+
+import numpy as np
+import torch
+from vissl.utils.instance_retrieval_utils.data_util import (
+    GemDescriptor,
+    InstanceRetrievalDataset,
+    _load_gnd_cached,
+    _parse_revisited_gnd,
+    gem,
+    l2n,
+)
+from vissl.utils.instance_retrieval_utils.evaluate import compute_ap_from_rank
+from vissl.utils.io import save_file
+from vissl.utils.test_utils import gpu_test, in_temporary_directory
+
+
+class TestInstanceRetrievalEvaluation(unittest.TestCase):
+    def test_compute_ap_from_rank(self):
+        # After removing the junk image 30, the positives are at the positions
+        # 0, 2 and 4 and the image 99 is never retrieved out of 4 positives:
+        # AP = 1/4 * ((1 + 1) / 2 + (1/2 + 2/3) / 2 + (2/4 + 3/5) / 2) = 8/15
+        rank = [10, 20, 30, 40, 50, 60]
+        good = {10, 40, 60, 99}
+        junk = {30}
+        self.assertAlmostEqual(compute_ap_from_rank(rank, good, junk), 8 / 15)
+        self.assertAlmostEqual(
+            compute_ap_from_rank(rank, good, junk, nres=3), 4 / 3 * 8 / 15
+        )
+
+        # Junk images do not count, positives retrieved first give AP = 1
+        self.assertAlmostEqual(compute_ap_from_rank([30, 10, 40], {10, 40}, junk), 1)
+
+        # No positive retrieved
+        self.assertAlmostEqual(compute_ap_from_rank([20, 30], good, junk), 0)
+
+    def _create_oxford_like_dataset(self, root: str):
+        os.makedirs(f"{root}/jpg")
+        os.makedirs(f"{root}/lab")
+        for i in range(6):
+            open(f"{root}/jpg/img_{i}.jpg", "w").close()
+        with open(f"{root}/lab/q1_query.txt", "w") as f:
+            f.write("oxc1_img_0 10 10 50 50\n")
+        with open(f"{root}/lab/q1_good.txt", "w") as f:
+            f.write("img_1\nimg_4\n")
+        # img_missing is a positive which is not part of the images, like the
+        # blacklisted images of Paris
+        with open(f"{root}/lab/q1_ok.txt", "w") as f:
+            f.write("img_missing\n")
+        with open(f"{root}/lab/q1_junk.txt", "w") as f:
+            f.write("img_2\n")
+
+    def test_instance_retrieval_dataset_score(self):
+        with in_temporary_directory() as temp_dir:
+            self._create_oxford_like_dataset(temp_dir)
+            dataset = InstanceRetrievalDataset(temp_dir, eval_binary_path="")
+            self.assertEqual(dataset.q_names, ["q1"])
+            self.assertEqual(dataset.relevants["q1"], [1, 4])
+            self.assertEqual(dataset.junk["q1"], [2])
+            self.assertEqual(dataset.non_relevants["q1"], [0, 3, 5])
+            # the positive missing from the images still counts in the recall
+            self.assertEqual(dataset.num_positives["q1"], 3)
+
+            # Ranking: img_0 ... img_5, img_2 is junk and the positives
+            # img_1 and img_4 end up at the positions 1 and 3 out of 3 positives:
+            # AP = 1/3 * ((0 + 1/2) / 2 + (1/3 + 2/4) / 2) = 2/9
+            sim_row = np.array([6.0, 5.0, 4.0, 3.0, 2.0, 1.0])
+            self.assertAlmostEqual(dataset.score_partial(0, sim_row), 2 / 9)
+
+
+class TestGroundTruthCache(unittest.TestCase):
+    @staticmethod
+    def _save_revisited_gnd(gnd_fname: str, num_queries: int):
+        gnd = {
+            "imlist": [f"img_{i}" for i in range(10)],
+            "qimlist": [f"query_{i}" for i in range(num_queries)],
+            "gnd": [
+                {
+                    "bbx": [1.0, 2.0, 30.0 + i, 40.0],
+                    "easy": list(range(i + 1)),
+                    "hard": [] if i % 2 == 0 else [9],
+                    "junk": [8],
+                }
+                for i in range(num_queries)
+            ],
+        }
+        save_file(gnd, gnd_fname)
+
+    def test_load_gnd_cached(self):
+        with in_temporary_directory() as temp_dir:
+            gnd_fname = f"{temp_dir}/gnd_test.pkl"
+            self._save_revisited_gnd(gnd_fname, num_queries=3)
+            parsed_files = []
+
+            def parse_gnd(fname):
+                parsed_files.append(fname)
+                return _parse_revisited_gnd(fname)
+
+            # The first call parses the ground truth, the second memory maps it
+            parsed = _load_gnd_cached(gnd_fname, parse_gnd)
+            cached = _load_gnd_cached(gnd_fname, parse_gnd)
+            self.assertEqual(parsed_files, [gnd_fname])
+            self.assertIsInstance(cached["imlist"], np.memmap)
+            self.assertTrue(np.array_equal(parsed["imlist"], cached["imlist"]))
+            self.assertTrue(np.array_equal(parsed["qimlist"], cached["qimlist"]))
+            for key in ["bbx", "easy", "hard", "junk"]:
+                self.assertEqual(len(parsed[key]), 3)
+                self.assertEqual(len(cached[key]), 3)
+                for p, c in zip(parsed[key], cached[key]):
+                    self.assertTrue(np.array_equal(p, c))
+            self.assertEqual(cached["hard"][0].shape, (0,))
+            self.assertEqual(cached["easy"][2].tolist(), [0, 1, 2])
+
+            # An updated ground truth file discards the cache
+            self._save_revisited_gnd(gnd_fname, num_queries=4)
+            updated = _load_gnd_cached(gnd_fname, parse_gnd)
+            self.assertEqual(parsed_files, [gnd_fname, gnd_fname])
+            self.assertEqual(len(updated["easy"]), 4)
+            cached = _load_gnd_cached(gnd_fname, parse_gnd)
+            self.assertEqual(len(parsed_files), 2)
+            self.assertEqual(len(cached["easy"]), 4)
+            self.assertEqual(cached["easy"][3].tolist(), [0, 1, 2, 3])
+
+    def test_load_gnd_not_local(self):
+        with in_temporary_directory():
+            parsed_files = []
+
+            def parse_gnd(fname):
+                parsed_files.append(fname)
+                return {"imlist": np.array(["img_0", "img_1"])}
+
+            # A ground truth which can't be stat-ed locally is parsed each time
+            gnd_fname = "manifold://dataset/gnd_test.pkl"
+            for _ in range(2):
+                data = _load_gnd_cached(gnd_fname, parse_gnd)
+                self.assertEqual(data["imlist"].tolist(), ["img_0", "img_1"])
+            self.assertEqual(parsed_files, [gnd_fname, gnd_fname])
+            self.assertEqual(os.listdir("."), [])
+
+
+class TestGemPooling(unittest.TestCase):
+    def test_gem_descriptor_scripted(self):
+        x = torch.rand(2, 16, 5, 5)
+        for p in [1, 3, math.inf]:
+            descriptor = torch.jit.script(GemDescriptor(p=p, add_bias=True))
+            out = descriptor(x)
+            ref = l2n(gem(x, p=p, add_bias=True))
+            self.assertEqual(out.shape, (2, 17))
+            self.assertTrue(torch.allclose(out, ref))
+
+    @gpu_test(gpu_count=1)
+    def test_gem_low_precision(self):
+        x = torch.rand(4, 64, 7, 7, device="cuda")
+        for p in [3, 4.0]:
+            ref = gem(x, p=p)
+            out = gem(x, p=p, dtype=torch.bfloat16)
+            self.assertEqual(out.dtype, torch.float32)
+            self.assertEqual(out.shape, ref.shape)
+            self.assertTrue(torch.allclose(out, ref, rtol=5e-3, atol=1e-4))
@@ -0,0 +1,35 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import unittest
+
+import numpy as np
+from vissl.utils.misc import get_indices_sparse
+
+
+class TestGetIndicesSparse(unittest.TestCase):
+    def _check_against_where(self, data: np.ndarray):
+        groups = get_indices_sparse(data)
+        self.assertEqual(len(groups), data.max() + 1)
+        for v, group in enumerate(groups):
+            expected = np.where(data == v)
+            self.assertEqual(len(group), len(expected))
+            for g, e in zip(group, expected):
+                self.assertEqual(g.tolist(), e.tolist())
+
+    def test_1d(self):
+        np.random.seed(0)
+        self._check_against_where(np.random.randint(0, 20, size=100))
+
+    def test_absent_values(self):
+        # 1, 2, 4 and 5 are absent and give empty groups
+        self._check_against_where(np.array([3, 0, 6, 3, 0, 6, 6]))
+
+    def test_2d(self):
+        np.random.seed(0)
+        # the values 10 to 14 are absent from the 2-D input
+        data = np.random.randint(0, 10, size=(7, 13))
+        data[3, 5] = 15
+        self._check_against_where(data)
@@ -26,6 +26,7 @@ from vissl.utils.instance_retrieval_utils.data_util import (
     InstanceRetrievalImageLoader,
     InstreDataset,
     MultigrainResize,
+    RetrievalImageDataset,
     RevisitedInstanceRetrievalDataset,
     WhiteningTrainingImageDataset,
     gem,
@@ -88,6 +89,23 @@ def gem_pool_and_save_features(features, p, add_bias, gem_out_fname):
     return features
 
 
+def get_image_loader(cfg, dataset, dataset_name, image_helper, indices, queries=False):
+    """
+    Build the DataLoader preparing the images of the specified indices in
+    worker processes, in the order of the indices.
+    """
+    image_dataset = RetrievalImageDataset(
+        dataset, dataset_name, image_helper, indices, queries=queries
+    )
+    # the images have different sizes so they are not batched
+    return torch.utils.data.DataLoader(
+        image_dataset,
+        batch_size=None,
+        num_workers=cfg.IMG_RETRIEVAL.NUM_DATALOADER_WORKERS,
+        pin_memory=True,
+    )
+
+
 def get_train_features(
     cfg,
     temp_dir,
@@ -100,21 +118,13 @@ def get_train_features(
 ):
     train_features = []
 
-    def process_train_image(i, out_dir):
+    def process_train_image(i, img, fname_out):
         if i % LOG_FREQUENCY == 0:
             logging.info(f"Train Image: {i}"),
-        fname_out = f"{out_dir}/{i}.npy"
-        if PathManager.exists(fname_out):
+        if img is None:
             feat = load_file(fname_out)
             train_features.append(feat)
         else:
-            fname_in = train_dataset.get_filename(i)
-            if is_revisited_dataset(train_dataset_name):
-                img = image_helper.load_and_prepare_revisited_image(fname_in)
-            elif is_whiten_dataset(train_dataset_name):
-                img = image_helper.load_and_prepare_whitening_image(fname_in)
-            else:
-                img = image_helper.load_and_prepare_image(fname_in, roi=None)
             v = torch.autograd.Variable(img.unsqueeze(0))
             vc = v.cuda()
             # the model output is a list always.
@@ -131,8 +141,18 @@ def get_train_features(
     num_images = train_dataset.get_num_images()
     out_dir = f"{temp_dir}/{train_dataset_name}_S{resize_img}_features_train"
     makedir(out_dir)
+    fnames_out = [f"{out_dir}/{i}.npy" for i in range(num_images)]
+    # only the images whose features are not saved yet need to be loaded
+    to_process = [i for i in range(num_images) if not PathManager.exists(fnames_out[i])]
+    images = iter(
+        get_image_loader(
+            cfg, train_dataset, train_dataset_name, image_helper, to_process
+        )
+    )
+    to_process = set(to_process)
     for i in range(num_images):
-        process_train_image(i, out_dir)
+        img = next(images) if i in to_process else None
+        process_train_image(i, img, fnames_out[i])
 
     if cfg.IMG_RETRIEVAL.FEATS_PROCESSING_TYPE == "gem":
         gem_out_fname = f"{out_dir}/{train_dataset_name}_GeM.npy"
@@ -148,23 +168,7 @@ def get_train_features(
     return train_features
 
 
-def process_eval_image(
-    cfg,
-    fname_in,
-    roi,
-    fname_out,
-    spatial_levels,
-    image_helper,
-    model,
-    pca,
-    eval_dataset_name,
-):
-    if is_revisited_dataset(eval_dataset_name):
-        img = image_helper.load_and_prepare_revisited_image(fname_in, roi=roi)
-    elif is_instre_dataset(eval_dataset_name):
-        img = image_helper.load_and_prepare_instre_image(fname_in)
-    else:
-        img = image_helper.load_and_prepare_image(fname_in, roi=roi)
+def process_eval_image(cfg, img, fname_out, spatial_levels, model, pca):
     v = torch.autograd.Variable(img.unsqueeze(0))
     vc = v.cuda()
     # the model output is a list always.
@@ -197,25 +201,25 @@ def get_dataset_features(
     logging.info(f"Getting features for dataset images: {num_images}")
     db_fname_out_dir = "{}/{}_S{}_db".format(temp_dir, eval_dataset_name, resize_img)
     makedir(db_fname_out_dir)
+    db_fnames_out = [f"{db_fname_out_dir}/{idx}.npy" for idx in range(num_images)]
+    # only the images whose features are not saved yet need to be loaded
+    to_process = [
+        idx for idx in range(num_images) if not PathManager.exists(db_fnames_out[idx])
+    ]
+    images = iter(
+        get_image_loader(cfg, eval_dataset, eval_dataset_name, image_helper, to_process)
+    )
+    to_process = set(to_process)
 
     for idx in range(num_images):
         if idx % LOG_FREQUENCY == 0:
             logging.info(f"Eval Dataset Image: {idx}"),
-        db_fname_in = eval_dataset.get_filename(idx)
-        db_fname_out = f"{db_fname_out_dir}/{idx}.npy"
-        if PathManager.exists(db_fname_out):
+        db_fname_out = db_fnames_out[idx]
+        if idx not in to_process:
             db_feature = load_file(db_fname_out)
         else:
             db_feature = process_eval_image(
-                cfg,
-                db_fname_in,
-                None,
-                db_fname_out,
-                spatial_levels,
-                image_helper,
-                model,
-                pca,
-                eval_dataset_name,
+                cfg, next(images), db_fname_out, spatial_levels, model, pca
             )
         features_dataset.append(db_feature)
 
@@ -253,26 +257,27 @@ def get_queries_features(
     logging.info(f"Getting features for queries: {num_queries}")
     q_fname_out_dir = "{}/{}_S{}_q".format(temp_dir, eval_dataset_name, resize_img)
     makedir(q_fname_out_dir)
+    q_fnames_out = [f"{q_fname_out_dir}/{idx}.npy" for idx in range(num_queries)]
+    # only the queries whose features are not saved yet need to be loaded
+    to_process = [
+        idx for idx in range(num_queries) if not PathManager.exists(q_fnames_out[idx])
+    ]
+    images = iter(
+        get_image_loader(
+            cfg, eval_dataset, eval_dataset_name, image_helper, to_process, queries=True
+        )
+    )
+    to_process = set(to_process)
 
     for idx in range(num_queries):
         if idx % LOG_FREQUENCY == 0:
             logging.info(f"Eval Query: {idx}"),
-        q_fname_in = eval_dataset.get_query_filename(idx)
-        roi = eval_dataset.get_query_roi(idx)
-        q_fname_out = f"{q_fname_out_dir}/{idx}.npy"
-        if PathManager.exists(q_fname_out):
+        q_fname_out = q_fnames_out[idx]
+        if idx not in to_process:
             query_feature = load_file(q_fname_out)
         else:
             query_feature = process_eval_image(
-                cfg,
-                q_fname_in,
-                roi,
-                q_fname_out,
-                spatial_levels,
-                image_helper,
-                model,
-                pca,
-                eval_dataset_name,
+                cfg, next(images), q_fname_out, spatial_levels, model, pca
             )
         features_queries.append(query_feature)
 
@@ -396,6 +401,13 @@ def instance_retrieval_test(args, cfg):
     # Create the image helper
     image_helper = InstanceRetrievalImageLoader(S=resize_img, transforms=transforms)
 
+    # INSTRE and whitening transforms center crop the images to a fixed size, in
+    # which case cudnn can benchmark and select the fastest kernels once. For the
+    # other datasets, every image has a different size and benchmarking each
+    # new size would only slow down the feature extraction.
+    if is_instre_dataset(eval_dataset_name) or is_whiten_dataset(eval_dataset_name):
+        torch.backends.cudnn.benchmark = True
+
     # Build the model on gpu and set in the eval mode
     model = build_retrieval_model(cfg)
     model = copy_model_to_gpu(model)
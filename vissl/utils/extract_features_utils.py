@@ -7,7 +7,7 @@
 import logging
 import os
 import re
-from typing import List, NamedTuple
+from typing import List, NamedTuple, Optional
 
 import numpy as np
 from fvcore.common.file_io import PathManager
@@ -63,6 +63,8 @@ class ExtractedFeaturesLoader:
             match = feature_regex.match(file_path)
             if match is not None:
                 prefixes.append(match.group(1))
+        # sorted so that the shards are merged in a deterministic order
+        prefixes.sort()
 
         # Yield all the files needed to merge the features dumped on
         # the different GPUs
@@ -86,19 +88,22 @@ class ExtractedFeaturesLoader:
 
     @classmethod
     def load_feature_shard(
-        cls, paths: ExtractedFeaturesShardPaths
+        cls, paths: ExtractedFeaturesShardPaths, mmap_mode: Optional[str] = None
     ) -> ExtractedFeatures:
         """
         Load a shard of the extracted features and returns its content:
         features, targets and indices.
+
+        The shard files can optionally be memory mapped with `mmap_mode`
+        (see numpy.load), in which case the data is only read when accessed.
         """
         logging.info(
             f"Loading:\n{paths.feature_file}\n{paths.targets_file}\n{paths.indices_file}"
         )
         return ExtractedFeatures(
-            features=load_file(paths.feature_file),
-            targets=load_file(paths.targets_file),
-            indices=load_file(paths.indices_file),
+            features=load_file(paths.feature_file, mmap_mode=mmap_mode),
+            targets=load_file(paths.targets_file, mmap_mode=mmap_mode),
+            indices=load_file(paths.indices_file, mmap_mode=mmap_mode),
         )
 
     @classmethod
@@ -119,26 +124,37 @@ class ExtractedFeaturesLoader:
         """
         logging.info(f"Merging features: {split} {layer}")
 
-        # Reassemble each feature shard (dumped by a given rank)
-        output_feats, output_targets = {}, {}
+        # Memory map each feature shard (dumped by a given rank): only the
+        # selected rows are read when copied into the merged arrays
         shard_paths = cls.get_shard_file_names(input_dir, split=split, layer=layer)
         if not shard_paths:
             raise ValueError(f"No features found for {split} {layer}")
+        shards = [cls.load_feature_shard(path, mmap_mode="r") for path in shard_paths]
+
+        # A sample index might be present in several shards, in which case the
+        # entry of the last shard (by sorted prefix) is kept. Reversing the
+        # indices before np.unique selects the last occurrence of each index,
+        # sorted by sample index
+        all_indices = np.concatenate([shard.indices for shard in shards])
+        shard_ids = np.concatenate(
+            [np.full(shard.num_samples, i) for i, shard in enumerate(shards)]
+        )
+        shard_rows = np.concatenate([np.arange(shard.num_samples) for shard in shards])
+        indices, last_reversed = np.unique(all_indices[::-1], return_index=True)
+        selected = len(all_indices) - 1 - last_reversed
 
-        for shard_path in shard_paths:
-            shard_content = cls.load_feature_shard(shard_path)
-            for idx in range(shard_content.num_samples):
-                index = shard_content.indices[idx]
-                output_feats[index] = shard_content.features[idx]
-                output_targets[index] = shard_content.targets[idx]
-
-        # Sort the entries by sample index
-        indices = np.array(sorted(output_targets.keys()))
-        features = np.array([output_feats[i] for i in indices])
-        targets = np.array([output_targets[i] for i in indices])
+        # Gather the selected rows of each shard into the merged arrays
+        N = len(indices)
+        feats_0, targets_0 = shards[0].features, shards[0].targets
+        features = np.empty((N,) + feats_0.shape[1:], dtype=feats_0.dtype)
+        targets = np.empty((N,) + targets_0.shape[1:], dtype=targets_0.dtype)
+        for i, shard in enumerate(shards):
+            out_pos = np.flatnonzero(shard_ids[selected] == i)
+            rows = shard_rows[selected[out_pos]]
+            features[out_pos] = shard.features[rows]
+            targets[out_pos] = shard.targets[rows]
 
         # Return the outputs
-        N = len(indices)
         if flatten_features:
             features = features.reshape(N, -1)
         output = {
@@ -8,20 +8,36 @@ import math
 import os
 import subprocess
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import List, Optional
 
 import numpy as np
 import scipy.io
 import torch
+import torch.nn as nn
 import torchvision.transforms.functional as TF
 from fvcore.common.file_io import PathManager
 from PIL import Image, ImageFile
 from torch.nn import functional as F
 from torchvision import transforms
 from vissl.utils.instance_retrieval_utils.evaluate import (
+    compute_ap_from_rank,
     compute_map,
     score_ap_from_ranks_1,
 )
-from vissl.utils.io import load_file
+from vissl.utils.io import load_file, makedir, save_file
+
+
+# to avoid crashing for truncated (corrupted images)
+ImageFile.LOAD_TRUNCATED_IMAGES = True
+
+try:
+    from turbojpeg import TJPF_RGB, TurboJPEG
+
+    _turbo_jpeg = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    _turbo_jpeg = None
 
 
 def is_revisited_dataset(dataset_name: str):
@@ -61,10 +77,14 @@ def add_bias_channel(x, dim: int = 1):
     """
     Adds a bias channel useful during pooling + whitening operation.
     """
-    bias_size = list(x.size())
-    bias_size[dim] = 1
-    one = x.new_ones(bias_size)
-    return torch.cat((x, one), dim)
+    # allocate the output once and fill it, rather than concatenating x with
+    # a separately allocated tensor of ones
+    out_size = list(x.size())
+    out_size[dim] += 1
+    out = x.new_empty(out_size)
+    out.narrow(dim, 0, x.size(dim)).copy_(x)
+    out.narrow(dim, x.size(dim), 1).fill_(1)
+    return out
 
 
 # Credits: Matthijs Douze
@@ -79,6 +99,21 @@ def flatten(x: torch.Tensor, keepdims: bool = False):
     return y
 
 
+def _gem_pool(x: torch.Tensor, p: float, eps: float, clamp: bool):
+    """
+    Gem pooling for a scalar pooling number, shared by gem() and GemDescriptor:
+    max pooling if p=inf, average pooling if p=1, otherwise clamp, x^p,
+    spatial mean and 1/p root.
+    """
+    if p == float("inf"):
+        return F.max_pool2d(x, (x.size(-2), x.size(-1)))
+    if p == 1.0:
+        return x.mean(dim=[-2, -1], keepdim=True)
+    if clamp:
+        x = x.clamp(min=eps)
+    return x.pow(p).mean(dim=[-2, -1], keepdim=True).pow(1.0 / p)
+
+
 # Credits: Matthijs Douze
 def gem(
     x: torch.Tensor,
@@ -87,6 +122,7 @@ def gem(
     clamp: bool = True,
     add_bias: bool = False,
     keepdims: bool = False,
+    dtype: Optional[torch.dtype] = None,
 ):
     """
     Gem pooling on the given tensor.
@@ -101,18 +137,29 @@ def gem(
         clamp (float): whether to clamp the tensor
         add_bias (bool): whether to add the biad channel
         keepdims (bool): whether to flatten or keep the dimensions as is
+        dtype (torch.dtype): if set (e.g. torch.bfloat16) and x is a float32 CUDA
+                             tensor, run only the spatial mean in this dtype
 
     Returns:
         x (torch.Tensor): Gem pooled tensor
     """
-    if p == math.inf or p == "inf":
-        x = F.max_pool2d(x, (x.size(-2), x.size(-1)))
-    elif p == 1 and not (torch.is_tensor(p) and p.requires_grad):
-        x = F.avg_pool2d(x, (x.size(-2), x.size(-1)))
-    else:
+    if torch.is_tensor(p) and p.requires_grad:
+        # learnable pooling number: eager ops so that p receives gradients
         if clamp:
             x = x.clamp(min=eps)
         x = F.avg_pool2d(x.pow(p), (x.size(-2), x.size(-1))).pow(1.0 / p)
+    elif (
+        dtype is not None
+        and x.is_cuda
+        and x.dtype == torch.float32
+        and float(p) not in [math.inf, 1.0]
+    ):
+        # clamp and x^p in float32, the 1/p root of the mean in float32 too
+        if clamp:
+            x = x.clamp(min=eps)
+        x = x.pow(p).to(dtype).mean(dim=[-2, -1], keepdim=True).float().pow(1.0 / p)
+    else:
+        x = _gem_pool(x, float(p), eps, clamp)
     if add_bias:
         x = add_bias_channel(x)
     if not keepdims:
@@ -133,8 +180,35 @@ def l2n(x: torch.Tensor, eps: float = 1e-6, dim: int = 1):
     Returns:
         x (torch.Tensor): L2 normalized tensor
     """
-    x = x / (torch.norm(x, p=2, dim=dim, keepdim=True) + eps).expand_as(x)
-    return x
+    # the keepdim norm broadcasts in the division, no need to expand it to the
+    # full shape of x first
+    return x / (x.norm(p=2, dim=dim, keepdim=True) + eps)
+
+
+class GemDescriptor(nn.Module):
+    """
+    Module computing the global descriptors of the feature maps:
+    Gem pooling -> (optional) bias channel -> L2 normalization, i.e.
+    l2n(gem(x, p=p, eps=eps, add_bias=add_bias)), as a module which can be
+    scripted with torch.jit.script (e.g. to be exported with a trunk).
+
+    Args:
+        p (float): pooling number, see gem()
+        add_bias (bool): whether to add the bias channel
+        eps (float): eps used to clamp the features and to L2 normalize
+    """
+
+    def __init__(self, p: float = 3.0, add_bias: bool = False, eps: float = 1e-6):
+        super().__init__()
+        self.p = float(p)
+        self.add_bias = add_bias
+        self.eps = eps
+
+    def forward(self, x: torch.Tensor):
+        x = _gem_pool(x, self.p, self.eps, True)
+        if self.add_bias:
+            x = add_bias_channel(x)
+        return l2n(flatten(x), eps=self.eps)
 
 
 # Credits: Matthijs Douze
@@ -177,7 +251,7 @@ class WhiteningTrainingImageDataset:
 
     def __init__(self, base_dir: str, image_list_file: str, num_samples: int = 0):
         with PathManager.open(image_list_file) as fopen:
-            self.image_list = fopen.readlines()
+            self.image_list = fopen.read().splitlines()
         if num_samples > 0:
             self.image_list = self.image_list[:num_samples]
         self.root = base_dir
@@ -188,7 +262,101 @@ class WhiteningTrainingImageDataset:
         return self.N_images
 
     def get_filename(self, i: int):
-        return f"{self.root}/{self.image_list[i][:-1]}"
+        return os.path.join(self.root, self.image_list[i])
+
+
+def _load_gnd_cached(gnd_fname: str, parse_gnd):
+    """
+    Load the ground truth of a retrieval dataset, caching it as .npy files in a
+    "<gnd_fname>_cache" directory next to gnd_fname.
+
+    The first call parses gnd_fname with parse_gnd, which returns a dict of
+    arrays or of lists of arrays (e.g. one array per query), and saves them.
+    The following calls memory map the saved arrays instead, so that the ground
+    truth is neither parsed again nor duplicated in memory across processes.
+    The cache records the size and modification time of gnd_fname, if the file
+    changed the cache is discarded and gnd_fname parsed again. If gnd_fname is
+    not a local file, it is parsed without caching.
+    """
+    try:
+        source_stat = os.stat(gnd_fname)
+    except OSError as e:
+        logging.warning(
+            f"Could not stat {gnd_fname}, not caching the ground truth: {e}"
+        )
+        return parse_gnd(gnd_fname)
+    source = {"size": source_stat.st_size, "mtime_ns": source_stat.st_mtime_ns}
+    cache_dir = f"{os.path.splitext(gnd_fname)[0]}_cache"
+    manifest_fname = f"{cache_dir}/manifest.json"
+    manifest = None
+    if PathManager.exists(manifest_fname):
+        manifest = load_file(manifest_fname)
+        if manifest.get("source") != source:
+            logging.info(f"{gnd_fname} changed, discarding the cache {cache_dir}")
+            manifest = None
+    if manifest is not None:
+        data = {}
+        for key in manifest["arrays"]:
+            data[key] = load_file(f"{cache_dir}/{key}.npy", mmap_mode="r")
+        for key in manifest["ragged"]:
+            values = load_file(f"{cache_dir}/{key}.npy", mmap_mode="r")
+            offsets = load_file(f"{cache_dir}/{key}_offsets.npy")
+            data[key] = np.split(values, offsets[1:-1])
+        return data
+
+    data = parse_gnd(gnd_fname)
+    try:
+        makedir(cache_dir)
+        # invalidate the previous cache before overwriting its arrays
+        if PathManager.exists(manifest_fname):
+            PathManager.rm(manifest_fname)
+        manifest = {"source": source, "arrays": [], "ragged": []}
+        for key, value in data.items():
+            if isinstance(value, list):
+                # the list of arrays is saved as the concatenated values and
+                # the offsets of each array
+                offsets = np.cumsum([0] + [len(v) for v in value])
+                save_file(np.concatenate(value), f"{cache_dir}/{key}.npy")
+                save_file(offsets, f"{cache_dir}/{key}_offsets.npy")
+                manifest["ragged"].append(key)
+            else:
+                save_file(value, f"{cache_dir}/{key}.npy")
+                manifest["arrays"].append(key)
+        # the manifest is saved last, it marks the cache as complete
+        save_file(manifest, manifest_fname, append_to_json=False)
+    except Exception as e:
+        logging.warning(f"Could not cache the ground truth to {cache_dir}: {e}")
+    return data
+
+
+def _parse_instre_gnd(gnd_fname: str):
+    """
+    Parse the INSTRE ground truth: the db and query images and the (1-based)
+    indices of the positive db images of each query.
+    """
+    gnd_instre = scipy.io.loadmat(gnd_fname)
+    return {
+        "imlist": np.array([fname[0] for fname in gnd_instre["imlist"][0]]),
+        "qimlist": np.array([fname[0] for fname in gnd_instre["qimlist"][0]]),
+        "positives": [np.asarray(g[0][0]) for g in gnd_instre["gnd"][0]],
+    }
+
+
+def _parse_revisited_gnd(gnd_fname: str):
+    """
+    Parse the Revisited Oxford and Paris ground truth: the db and query images
+    and, for each query, its bounding box and its easy, hard and junk db images.
+    """
+    cfg = load_file(gnd_fname)
+    data = {"imlist": np.array(cfg["imlist"]), "qimlist": np.array(cfg["qimlist"])}
+    for key, dtype in [
+        ("bbx", np.float64),
+        ("easy", np.int64),
+        ("hard", np.int64),
+        ("junk", np.int64),
+    ]:
+        data[key] = [np.asarray(g[key], dtype=dtype) for g in cfg["gnd"]]
+    return data
 
 
 class InstreDataset:
@@ -199,10 +367,13 @@ class InstreDataset:
 
     def __init__(self, dataset_path: str, num_samples: int = 0):
         self.base_dir = dataset_path
-        gnd_instre = scipy.io.loadmat(f"{self.base_dir}/gnd_instre.mat")
-        self.gnd = gnd_instre["gnd"][0]
-        self.qimlist = [fname[0] for fname in gnd_instre["qimlist"][0]]
-        self.db_imlist = [fname[0] for fname in gnd_instre["imlist"][0]]
+        gnd_instre = _load_gnd_cached(
+            f"{self.base_dir}/gnd_instre.mat", _parse_instre_gnd
+        )
+        # the 1-based indices of the positive db images of each query
+        self.gnd = gnd_instre["positives"]
+        self.qimlist = gnd_instre["qimlist"]
+        self.db_imlist = gnd_instre["imlist"]
 
         if num_samples > 0:
             self.qimlist = self.qimlist[:num_samples]
@@ -255,14 +426,23 @@ class InstreDataset:
         """
         nq, nb = ranks.shape
         gnd = self.gnd
+        positives_list = [np.asarray(gnd[i] - 1, dtype=np.int64) for i in range(nq)]
+        num_positives = [len(positives) for positives in positives_list]
+        # build the positives of all queries at once and gather them in rank
+        # order with a single call rather than one allocation per query
+        ok = np.zeros((nq, nb), dtype=bool)
+        query_ids = np.repeat(np.arange(nq), num_positives)
+        ok[query_ids, np.concatenate(positives_list)] = True
+        ok_ranked = np.take_along_axis(ok, ranks, axis=1)
+        # ranks of the positives of all the queries, split per query: the flat
+        # indices are row major so each query's ranks are contiguous and sorted
+        pos_per_query = np.split(
+            np.flatnonzero(ok_ranked) % nb, np.cumsum(ok_ranked.sum(axis=1))[:-1]
+        )
         sum_ap = 0
         sum_ap_val = 0
         for i in range(nq):
-            positives = gnd[i][0][0] - 1
-            ok = np.zeros(nb, dtype=bool)
-            ok[positives] = True
-            pos = np.where(ok[ranks[i]])[0]
-            ap = score_ap_from_ranks_1(pos, len(positives))
+            ap = score_ap_from_ranks_1(pos_per_query[i], num_positives[i])
             sum_ap += ap
             if i in self.val_subset:
                 sum_ap_val += ap
@@ -272,7 +452,7 @@ class InstreDataset:
         """
         For the input scores of the model, calculate the AP metric
         """
-        ranks = scores.argsort(axis=1)[:, ::-1]
+        ranks = np.argsort(-scores, axis=1)
         mAP, mAP_val = self.eval_from_ranks(ranks)
         if verbose:
             logging.info(f"INSTRE mAP={mAP} val {mAP_val}")
@@ -295,7 +475,12 @@ class RevisitedInstanceRetrievalDataset:
 
         # loading imlist, qimlist, and gnd, in cfg as a dict
         gnd_fname = f"{dir_main}/{dataset}/gnd_{dataset}.pkl"
-        cfg = load_file(gnd_fname)
+        gnd = _load_gnd_cached(gnd_fname, _parse_revisited_gnd)
+        cfg = {"imlist": gnd["imlist"], "qimlist": gnd["qimlist"]}
+        cfg["gnd"] = [
+            {key: gnd[key][i] for key in ["bbx", "easy", "hard", "junk"]}
+            for i in range(len(gnd["qimlist"]))
+        ]
         cfg["gnd_fname"] = gnd_fname
         cfg["ext"] = ".jpg"
         cfg["qext"] = ".jpg"
@@ -348,39 +533,40 @@ class RevisitedInstanceRetrievalDataset:
         For the input similarity scores of the model, calculate the mean AP metric
         and mean Precision@k metrics.
         """
-        sim = sim.T
         # Credits: https://github.com/filipradenovic/revisitop/blob/master/python/example_evaluate.py  # NOQA
-        ranks = np.argsort(-sim, axis=0)
+        # sort each query row directly instead of transposing the similarity
+        # matrix first. compute_map expects ranks of shape db_size X #queries.
+        ranks = np.argsort(-sim, axis=1).T
         # revisited evaluation
         gnd = self.cfg["gnd"]
         # evaluate ranks
         ks = [1, 5, 10]
 
+        # convert the ground truth of each query to arrays once for all the
+        # evaluation protocols below
+        easy = [np.asarray(g["easy"]) for g in gnd]
+        hard = [np.asarray(g["hard"]) for g in gnd]
+        junk = [np.asarray(g["junk"]) for g in gnd]
+
         # search for easy
-        gnd_t = []
-        for i in range(len(gnd)):
-            g = {}
-            g["ok"] = np.concatenate([gnd[i]["easy"]])
-            g["junk"] = np.concatenate([gnd[i]["junk"], gnd[i]["hard"]])
-            gnd_t.append(g)
+        gnd_t = [
+            {"ok": e, "junk": np.concatenate([j, h])}
+            for e, h, j in zip(easy, hard, junk)
+        ]
         mapE, apsE, mprE, prsE = compute_map(ranks, gnd_t, ks)
 
         # search for easy & hard
-        gnd_t = []
-        for i in range(len(gnd)):
-            g = {}
-            g["ok"] = np.concatenate([gnd[i]["easy"], gnd[i]["hard"]])
-            g["junk"] = np.concatenate([gnd[i]["junk"]])
-            gnd_t.append(g)
+        gnd_t = [
+            {"ok": np.concatenate([e, h]), "junk": j}
+            for e, h, j in zip(easy, hard, junk)
+        ]
         mapM, apsM, mprM, prsM = compute_map(ranks, gnd_t, ks)
 
         # search for hard
-        gnd_t = []
-        for i in range(len(gnd)):
-            g = {}
-            g["ok"] = np.concatenate([gnd[i]["hard"]])
-            g["junk"] = np.concatenate([gnd[i]["junk"], gnd[i]["easy"]])
-            gnd_t.append(g)
+        gnd_t = [
+            {"ok": h, "junk": np.concatenate([j, e])}
+            for e, h, j in zip(easy, hard, junk)
+        ]
         mapH, apsH, mprH, prsH = compute_map(ranks, gnd_t, ks)
 
         logging.info(
@@ -402,6 +588,27 @@ class RevisitedInstanceRetrievalDataset:
         )
 
 
+def open_image(fname: str):
+    """
+    Read and decode the image from the filename. The image is fully decoded
+    before the file is closed.
+
+    JPEG images are decoded with libjpeg-turbo if PyTurboJPEG is installed
+    (`pip install PyTurboJPEG`), falling back to PIL otherwise.
+    """
+    with PathManager.open(fname, "rb") as f:
+        if _turbo_jpeg is not None and fname.lower().endswith((".jpg", ".jpeg")):
+            try:
+                arr = _turbo_jpeg.decode(f.read(), pixel_format=TJPF_RGB)
+                return Image.fromarray(arr)
+            except OSError:
+                # let PIL deal with the images libjpeg-turbo can't decode
+                f.seek(0)
+        im = Image.open(f)
+        im.load()
+    return im
+
+
 # Credits: https://github.com/facebookresearch/deepcluster/blob/master/eval_retrieval.py    # NOQA
 # Adapted by: Priya Goyal (prigoyal@fb.com)
 class InstanceRetrievalImageLoader:
@@ -417,20 +624,21 @@ class InstanceRetrievalImageLoader:
         """
         Apply the pre-defined transforms on the image.
         """
-        im_size_hw = np.array((im.size[1], im.size[0]))
+        # plain python arithmetic: the sizes are scalars, numpy would only add
+        # overhead. PIL sizes are (W, H).
+        w, h = im.size
+        max_size = max(w, h)
         if self.S == -1:
             ratio = 1.0
         elif self.S == -2:
-            if np.max(im_size_hw) > 124:
-                ratio = 1024.0 / np.max(im_size_hw)
+            if max_size > 124:
+                ratio = 1024.0 / max_size
             else:
                 ratio = -1
         else:
-            ratio = float(self.S) / np.max(im_size_hw)
-        new_size = tuple(np.round(im_size_hw * ratio).astype(np.int32))
-        im_resized = self.transforms(
-            im.resize((new_size[1], new_size[0]), Image.BILINEAR)
-        )
+            ratio = float(self.S) / max_size
+        new_w, new_h = int(round(w * ratio)), int(round(h * ratio))
+        im_resized = self.transforms(im.resize((new_w, new_h), Image.BILINEAR))
         return im_resized, ratio
 
     def load_and_prepare_whitening_image(self, fname):
@@ -438,8 +646,7 @@ class InstanceRetrievalImageLoader:
         from the filename, load the whitening image and prepare it to be used by
         applying data transforms
         """
-        with PathManager.open(fname, "rb") as f:
-            im = Image.open(f)
+        im = open_image(fname)
         if im.mode != "RGB":
             im = im.convert(mode="RGB")
         if self.transforms is not None:
@@ -451,8 +658,7 @@ class InstanceRetrievalImageLoader:
         from the filename, load the db or query image and prepare it to be used by
         applying data transforms
         """
-        with PathManager.open(fname, "rb") as f:
-            im = Image.open(f)
+        im = open_image(fname)
         if self.transforms is not None:
             im = self.transforms(im)
         return im
@@ -464,14 +670,13 @@ class InstanceRetrievalImageLoader:
         the image once again. ROI format is (xmin,ymin,xmax,ymax)
         """
         # Read image, get aspect ratio, and resize such as the largest side equals S
-        with PathManager.open(fname, "rb") as f:
-            im = Image.open(f).convert(mode="RGB")
+        im = open_image(fname).convert(mode="RGB")
         im_resized, ratio = self.apply_img_transform(im)
         # If there is a roi, adapt the roi to the new size and crop. Do not rescale
         # the image once again
         if roi is not None:
             # ROI format is (xmin,ymin,xmax,ymax)
-            roi = np.round(roi * ratio).astype(np.int32)
+            roi = np.round(np.array(roi, dtype=np.float32) * ratio).astype(np.int32)
             im_resized = im_resized[:, roi[1] : roi[3], roi[0] : roi[2]]
         return im_resized
 
@@ -480,18 +685,68 @@ class InstanceRetrievalImageLoader:
         Load the image, crop the roi from the image if the roi is not None,
         apply the image transforms.
         """
-        # to avoid crashing for truncated (corrupted images)
-        ImageFile.LOAD_TRUNCATED_IMAGES = True
-        # open path as file to avoid ResourceWarning
-        # (https://github.com/python-pillow/Pillow/issues/835)
-        with PathManager.open(img_path, "rb") as f:
-            img = Image.open(f).convert("RGB")
+        img = open_image(img_path).convert("RGB")
         if roi is not None:
-            im_resized = img.crop(roi)
+            # the revisited protocol crops the query to its bounding box in the
+            # original image, then resizes the crop
+            # See: https://github.com/filipradenovic/cnnimageretrieval-pytorch
+            img = img.crop(roi)
         im_resized, _ = self.apply_img_transform(img)
         return im_resized
 
 
+class RetrievalImageDataset(torch.utils.data.Dataset):
+    """
+    Map-style dataset returning the prepared db (or query) images of one of the
+    retrieval datasets above. Used with a torch DataLoader so that the images
+    are decoded and resized in worker processes while the model extracts the
+    features of the previous images.
+
+    Args:
+        dataset: the retrieval dataset (InstreDataset, WhiteningTrainingImageDataset,
+                 RevisitedInstanceRetrievalDataset or InstanceRetrievalDataset)
+        dataset_name (str): name of the dataset, decides how the images are loaded
+        image_helper (InstanceRetrievalImageLoader): loader preparing the images
+        indices (List[int]): indices of the db (or query) images to load
+        queries (bool): whether to load the query images (cropped to their ROI)
+                        instead of the db images
+    """
+
+    def __init__(
+        self,
+        dataset,
+        dataset_name: str,
+        image_helper: InstanceRetrievalImageLoader,
+        indices: List[int],
+        queries: bool = False,
+    ):
+        self.dataset = dataset
+        self.dataset_name = dataset_name
+        self.image_helper = image_helper
+        self.indices = indices
+        self.queries = queries
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, idx: int):
+        i = self.indices[idx]
+        if self.queries:
+            fname = self.dataset.get_query_filename(i)
+            roi = self.dataset.get_query_roi(i)
+        else:
+            fname = self.dataset.get_filename(i)
+            roi = None
+
+        if is_revisited_dataset(self.dataset_name):
+            return self.image_helper.load_and_prepare_revisited_image(fname, roi=roi)
+        elif is_instre_dataset(self.dataset_name):
+            return self.image_helper.load_and_prepare_instre_image(fname)
+        elif is_whiten_dataset(self.dataset_name):
+            return self.image_helper.load_and_prepare_whitening_image(fname)
+        return self.image_helper.load_and_prepare_image(fname, roi=roi)
+
+
 class InstanceRetrievalDataset:
     """
     A dataset class used for the Instance retrieval datasets:
@@ -575,10 +830,18 @@ class InstanceRetrievalDataset:
         self.relevants = {}
         self.junk = {}
         self.non_relevants = {}
+        # number of ground truth positives, some of which might not be part of
+        # the images (blacklisted images) but still count in the AP
+        self.num_positives = {}
 
         self.filename_to_name = {}
         self.name_to_filename = OrderedDict()
         self.q_roi = {}
+        # map each image name to its index once, so that the membership of the
+        # relevants / junk lists is a dict lookup rather than a scan of the
+        # whole image list for every query
+        name_to_idx = {name: i for i, name in enumerate(self.img_filenames)}
+        all_indices = np.arange(len(self.img_filenames))
         for e in lab_filenames:
             if e.endswith("_query.txt"):
                 q_name = e[: -len("_query.txt")]
@@ -596,29 +859,25 @@ class InstanceRetrievalDataset:
                     good = good.union({e.strip() for e in fopen})
                 with PathManager.open(f"{self.lab_root}/{q_name}_junk.txt") as fopen:
                     junk = {e.strip() for e in fopen}
-                good_plus_junk = good.union(junk)
-                self.relevants[q_name] = [
-                    i
-                    for i in range(len(self.img_filenames))
-                    if self.img_filenames[i] in good
-                ]
-                self.junk[q_name] = [
-                    i
-                    for i in range(len(self.img_filenames))
-                    if self.img_filenames[i] in junk
-                ]
-                self.non_relevants[q_name] = [
-                    i
-                    for i in range(len(self.img_filenames))
-                    if self.img_filenames[i] not in good_plus_junk
-                ]
+                self.relevants[q_name] = sorted(
+                    name_to_idx[n] for n in good if n in name_to_idx
+                )
+                self.junk[q_name] = sorted(
+                    name_to_idx[n] for n in junk if n in name_to_idx
+                )
+                self.num_positives[q_name] = len(good)
+                self.non_relevants[q_name] = np.setdiff1d(
+                    all_indices,
+                    np.union1d(self.relevants[q_name], self.junk[q_name]),
+                    assume_unique=True,
+                ).tolist()
                 self.q_roi[q_name] = np.array(
                     [float(q) for q in q_data[1:]], dtype=np.float32
                 )
 
         self.q_names = list(self.name_to_filename.keys())
         self.q_index = np.array(
-            [self.img_filenames.index(self.name_to_filename[qn]) for qn in self.q_names]
+            [name_to_idx[self.name_to_filename[qn]] for qn in self.q_names]
         )
 
         self.N_images = len(self.img_filenames)
@@ -628,28 +887,54 @@ class InstanceRetrievalDataset:
             self.N_queries = min(self.N_queries, num_samples)
             self.N_images = min(self.N_images, num_samples)
 
-    def score(self, sim, temp_dir):
+    def score(self, sim, temp_dir, strict_compat=False):
         """
-        From the input similarity score, compute the mean average precision
+        From the input similarity score, compute the mean average precision.
+
+        The AP is computed in python, following the compute_ap program of the
+        Oxford and Paris datasets. If strict_compat=True, the compute_ap binary
+        (eval_binary_path) is run on each query instead, to verify the results.
         """
-        if not os.path.exists(temp_dir):
-            os.makedirs(temp_dir)
-        idx = np.argsort(sim, axis=1)[:, ::-1]
-        maps = [
-            self.score_rnk_partial(i, idx[i], temp_dir) for i in range(self.N_queries)
-        ]
+        if strict_compat:
+            if not os.path.exists(temp_dir):
+                os.makedirs(temp_dir)
+            score_query = partial(self.score_rnk_partial, temp_dir=temp_dir)
+        else:
+            score_query = self.score_partial
+        # the queries are independent: rank and evaluate them concurrently. The
+        # work is mostly spent in numpy (or in the evaluation binary) which
+        # releases the GIL, so threads are enough
+        with ThreadPoolExecutor() as executor:
+            maps = list(
+                executor.map(lambda i: score_query(i, sim[i]), range(self.N_queries))
+            )
         for i in range(self.N_queries):
             logging.info("{0}: {1:.2f}".format(self.q_names[i], 100 * maps[i]))
         logging.info(20 * "-")
         logging.info("Mean: {0:.2f}".format(100 * np.mean(maps)))
 
-    def score_rnk_partial(self, i, idx, temp_dir):
+    def score_partial(self, i, sim_row):
+        """
+        Compute the AP for a given single query from its similarity scores
+        to the db images
+        """
+        q_name = self.q_names[i]
+        idx = np.argsort(-sim_row)
+        return compute_ap_from_rank(
+            idx, self.relevants[q_name], self.junk[q_name], self.num_positives[q_name]
+        )
+
+    def score_rnk_partial(self, i, sim_row, temp_dir):
         """
-        Compute the mean AP for a given single query
+        Compute the AP for a given single query from its similarity scores
+        to the db images, using the compute_ap binary
         """
+        idx = np.argsort(-sim_row)
         rnk = np.array(self.img_filenames[: self.N_images])[idx]
-        with PathManager.open(f"{temp_dir}/{self.q_names[i]}.rnk", "w") as f:
-            f.write("\n".join(rnk) + "\n")
+        # the ranking is written in a single call, temp_dir is best on a tmpfs
+        # (e.g. /dev/shm) to avoid the disk I/O
+        with PathManager.open(f"{temp_dir}/{self.q_names[i]}.rnk", "wb") as f:
+            f.write(b"\n".join(n.encode() for n in rnk) + b"\n")
         cmd = (
             f"{self.eval_binary_path} {self.lab_root}{self.q_names[i]} "
             f"{temp_dir}/{self.q_names[i]}.rnk"
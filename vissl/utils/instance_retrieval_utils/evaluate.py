@@ -6,12 +6,21 @@
 import numpy as np
 
 
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
 # AP routine of the Holidays and INSTRE package
 # Credits: Matthijs Douze
 def score_ap_from_ranks_1(ranks, nres):
     """
     Compute the average precision of one search.
 
+    The loop over the ranks is JIT compiled if numba is installed
+    (`pip install numba`).
+
     Args:
         ranks: ordered list of ranks of true positives
         nres: total number of positives in dataset
@@ -19,6 +28,10 @@ def score_ap_from_ranks_1(ranks, nres):
     Returns:
         ap (float): the average precision following the Holidays and the INSTRE package
     """
+    return _score_ap_from_ranks_1(np.asarray(ranks, dtype=np.int64), nres)
+
+
+def _score_ap_from_ranks_1(ranks, nres):
     # accumulate trapezoids in PR-plot
     ap = 0.0
     # All have an x-size of:
@@ -36,6 +49,35 @@ def score_ap_from_ranks_1(ranks, nres):
     return ap
 
 
+if njit is not None:
+    _score_ap_from_ranks_1 = njit(cache=True)(_score_ap_from_ranks_1)
+
+
+# AP routine of the compute_ap program of the Oxford and Paris datasets
+# See: https://www.robots.ox.ac.uk/~vgg/data/oxbuildings/compute_ap.cpp
+def compute_ap_from_rank(rank, good, junk, nres=None):
+    """
+    Compute the average precision of one search, the same way as the compute_ap
+    program of the Oxford and Paris datasets: the junk images are removed from
+    the ranked list, then the PR-plot trapezoids are accumulated.
+
+    Args:
+        rank: ordered list of the retrieved images (names or indices)
+        good: the positive images for the query
+        junk: the images to ignore for the query
+        nres: total number of positives, defaults to len(good)
+
+    Returns:
+        ap (float): the average precision of the search
+    """
+    if nres is None:
+        nres = len(good)
+    rank = np.asarray(rank)
+    rank = rank[~np.isin(rank, list(junk))]
+    pos = np.flatnonzero(np.isin(rank, list(good)))
+    return score_ap_from_ranks_1(pos, nres)
+
+
 # Credits: https://github.com/filipradenovic/revisitop/blob/master/python/evaluate.py
 def compute_ap(ranks, nres):
     """
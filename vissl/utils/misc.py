@@ -16,7 +16,6 @@ import pkg_resources
 import torch
 import torch.multiprocessing as mp
 from fvcore.common.file_io import PathManager
-from scipy.sparse import csr_matrix
 from vissl.utils.extract_features_utils import ExtractedFeaturesLoader
 
 
@@ -176,10 +175,16 @@ def set_dataloader_seeds(_worker_id: int):
 def get_indices_sparse(data):
     """
     Is faster than np.argwhere. Used in loss functions like swav loss, etc
+
+    Returns, for each value v in [0, data.max()], the indices of data equal
+    to v (empty if v is not present), as returned by np.unravel_index.
     """
-    cols = np.arange(data.size)
-    M = csr_matrix((cols, (data.ravel(), cols)), shape=(data.max() + 1, data.size))
-    return [np.unravel_index(row.data, data.shape) for row in M]
+    flat = data.ravel()
+    # group the flat indices by value: a stable sort keeps them increasing
+    # within a group, and the counts give the group boundaries
+    order = np.argsort(flat, kind="stable")
+    boundaries = np.cumsum(np.bincount(flat))[:-1]
+    return [np.unravel_index(g, data.shape) for g in np.split(order, boundaries)]
 
 
 def merge_features(input_dir: str, split: str, layer: str):